@@ -1,10 +1,26 @@
+import asyncio
+import functools
+import html
 import sqlite3
 import sys
-import socket
+import threading
+from urllib.parse import parse_qsl
+from connection import serve
+
+# Queries used while handling requests. Keeping them as constants lets sqlite reuse their prepared statements.
+INSERT_ACTIVITY = "INSERT INTO activities (name) VALUES (?) ON CONFLICT DO NOTHING"
+DELETE_ACTIVITY = "DELETE FROM activities WHERE name=?"
+SELECT_ACTIVITY = "SELECT 1 FROM activities WHERE name=? LIMIT 1"
 
 class ActivityServer:
-    # List of accepted sub-URLs that the server can handle
-    accepted_sub_urls = ['/add', '/remove', '/check']
+    # Set of accepted sub-URLs that the server can handle
+    accepted_sub_urls = frozenset({'/add', '/remove', '/check'})
+    # Parameters that the sub-URLs require
+    required_parameters = ('name',)
+    # Sub-URLs that change the database, they are handled one at a time under the lock
+    write_sub_urls = frozenset({'/add', '/remove'})
+    # Sets of the parameters that each sub-URL requires
+    name_parameters = frozenset({'name'})
 
     # HTML template for responses
     base_html = """<HTML>
@@ -14,52 +30,98 @@ class ActivityServer:
 <BODY>{}</BODY>
 </HTML>"""
 
+    # The pre-encoded parts of the HTML template around the title and the body
+    html_head, html_middle, html_tail = (part.encode() for part in base_html.split('{}'))
+
+    # Pre-encoded status lines of the responses
+    ok_status = b'HTTP/1.1 200 OK\r\n\r\n'
+    bad_request_status = b'HTTP/1.1 400 Bad Request\r\n\r\n'
+    forbidden_status = b'HTTP/1.1 403 Forbidden\r\n\r\n'
+    not_found_status = b'HTTP/1.1 404 Not Found\r\n\r\n'
+    internal_error_status = b'HTTP/1.1 500 Internal Server Error\r\n\r\n'
+    invalid_url_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid URL", html_tail))
+    request_too_large_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Request too large", html_tail))
+    internal_error_response = b''.join((internal_error_status, html_head, b"Error", html_middle, b"Internal server error", html_tail))
+
+    # Responses whose content never changes, built once so these paths only return them
+    activity_exists_response = b''.join((forbidden_status, html_head, b"Error", html_middle, b"Activity already exists", html_tail))
+    check_exists_response = b''.join((ok_status, html_head, b"Activity Check", html_middle, b"Activity Exists", html_tail))
+    check_not_found_response = b''.join((not_found_status, html_head, b"Activity Check", html_middle, b"Activity does not exist", html_tail))
+
     def __init__(self):
-        # The self.db variable will be used to store the connection to the database. It is initialized as None.
-        self.db = None
+        # Each worker thread keeps its own connection to the database in self.local, so the threads can read at the same time
+        self.local = threading.local()
+        # The self.lock variable is used to make sure only one thread writes to the database at a time.
+        self.lock = threading.Lock()
+
+        # Maps each accepted sub-URL to the method that handles it
+        self.routes = {
+            '/add': self.get_add,
+            '/remove': self.get_remove,
+            '/check': self.get_check,
+        }
+
+        # The check responses of recently checked activities, so checking the same activity again does not query the database.
+        # They are cached together with the generation of the activities, which changes whenever an activity is added or removed.
+        # The server runs as a single process and must be the only one using activity.db, changes made by another process are not seen here.
+        self.check_responses = functools.lru_cache(maxsize=1024)(self.build_check_response)
+        self.check_generation = 0
+
+        # Error responses for each missing parameter, built once so a bad request only needs a lookup
+        self.parameter_errors = {
+            parameter: self.build_response(self.bad_request_status, b"Error", f"{parameter} parameter is mandatory".encode())
+            for parameter in self.required_parameters
+        }
 
     def handle_request(self, request):
-        # If the database connection has not been established, create it and the tables
-        if self.db is None:
-            self.db = sqlite3.connect('activity.db')
-            self.create_tables()
-
-        # Parse the request and get the sub-URL and query parameters
-        sub_url, query = self.parse_request(request)
-
-        # Call the appropriate method based on the sub-URL
-        if sub_url == '/add':
-            response = self.get_add(query)
-        elif sub_url == '/remove':
-            response = self.get_remove(query)
-        elif sub_url == '/check':
-            response = self.get_check(query)
-        else:
-            # If the sub-url is not in the list of accepted sub-urls, return a Bad Request error.
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Invalid URL")}'.encode()
-
-        return response
+        # Parse the request and get the sub-URL and query parameters.
+        # Parsing does not touch the database, so the worker threads do it in parallel outside of the lock.
+        try:
+            sub_url, query = self.parse_request(request)
+        except (IndexError, UnicodeDecodeError):
+            # If the request line is malformed, return a Bad Request error
+            return self.invalid_url_response
+
+        # Look up the method for the sub-URL
+        handler = self.routes.get(sub_url)
+        if handler is None:
+            # If the sub-url is not in the set of accepted sub-urls, return a Bad Request error.
+            return self.invalid_url_response
+
+        # If this worker thread has not connected to the database yet, create its connection and the tables
+        if not hasattr(self.local, 'db'):
+            db = sqlite3.connect('activity.db', isolation_level=None, cached_statements=256)
+            cursor = self.create_tables(db)
+            # Keep the connection only once the tables are ready, so if creating them fails the next request tries again
+            self.local.db, self.local.cursor = db, cursor
+
+        # Call the method for the sub-URL, the requests that change the database are handled under the lock
+        if sub_url in self.write_sub_urls:
+            with self.lock:
+                return handler(query)
+        return handler(query)
 
 
     def parse_request(self, request):
         # This method parses the request to get the sub-url and the query parameters.
-        # Split the request by spaces and get the second element, which is the URL. Decode it to get a string.
-        url = request.split(b' ', 2)[1].decode()
+        # Split the request by spaces and get the second element, which is the URL
+        url = request.split(b' ', 2)[1]
 
-        #Split the URL by the '?' character to separate the sub-url from the query parameters. The sub-url is the first element
-        sub_url = url.split('?')[0]
+        # Split the URL into the sub-url, which is its path, and the query string.
+        # This is done on the bytes, only the two short parts are decoded to strings.
+        path, _, query_string = url.partition(b'?')
+        sub_url = path.decode()
         if not sub_url in self.accepted_sub_urls:
-            # If the sub-URL is not in the list of accepted sub-URLs, return it
+            # If the sub-URL is not in the set of accepted sub-URLs, return it
             return sub_url, False
-        # Use a dictionary comprehension to create a dictionary where the keys are the parameter names and the values are the parameter values.
-        # Split the query string by '&' to get a list of individual parameters.
-        query = {param.split('=')[0]:param.split('=')[1] for param in url.split('?')[1].split('&')}
 
+        # Create a dictionary where the keys are the parameter names and the values are the parameter values.
+        query = dict(parse_qsl(query_string.decode(), keep_blank_values=True))
         return sub_url, query
 
     def get_add(self, query):
         # Check that the required parameters are present in the query
-        parameters_check = self.check_parameters(['name'], query)
+        parameters_check = self.check_parameters(self.name_parameters, query)
         if parameters_check:
             # If the required parameters are not present, return the error response
             return parameters_check
@@ -68,26 +130,24 @@ class ActivityServer:
         activity_name = query['name']
 
         # Get a cursor for the database connection
-        cursor = self.db.cursor()
+        cursor = self.local.cursor
 
-        # Check if an activity with the same name already exists
-        cursor.execute("SELECT * FROM activities WHERE name=?", (activity_name,))
-        if cursor.fetchone() is not None:
+        # Insert the new activity into the database, nothing is inserted if an activity with the same name already exists
+        cursor.execute(INSERT_ACTIVITY, (activity_name,))
+        if cursor.rowcount == 0:
             # If the activity already exists, return a "403 Forbidden" response
-            response = f'HTTP/1.1 403 Forbidden\n\n{self.base_html.format("Error", "Activity already exists")}'.encode()
+            response = self.activity_exists_response
             return response
-
-        # Insert the new activity into the database
-        cursor.execute("INSERT INTO activities (name) VALUES (?)", (activity_name,))
-        self.db.commit()
+        # The activity exists now, so the cached check responses are outdated
+        self.invalidate_checks()
 
         # Return a "200 OK" response indicating that the activity was added
-        response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Activity Added", f"Activity with name {activity_name} is added")}'.encode()
+        response = self.build_response(self.ok_status, b"Activity Added", f"Activity with name {html.escape(activity_name)} is added".encode())
         return response
 
     def get_remove(self, query):
         # Check that the required parameters are present in the query
-        parameters_check = self.check_parameters(['name'], query)
+        parameters_check = self.check_parameters(self.name_parameters, query)
         if parameters_check:
             # If the required parameters are not present, return the error response
             return parameters_check
@@ -96,80 +156,83 @@ class ActivityServer:
         activity_name = query['name']
 
         # Get a cursor for the database connection
-        cursor = self.db.cursor()
-
-        # Check if an activity with the given name exists
-        cursor.execute("SELECT * FROM activities WHERE name=?", (activity_name,))
-        if cursor.fetchone() is None:
-            # If the activity does not exist, return a "403 Forbidden" response
-            response = f'HTTP/1.1 403 Forbidden\n\n{self.base_html.format("Error", f"Activity with name {activity_name} does not exist")}'.encode()
-            return response
+        cursor = self.local.cursor
 
         # Delete the activity from the database
-        cursor.execute("DELETE FROM activities WHERE name=?", (activity_name,))
-        self.db.commit()
+        cursor.execute(DELETE_ACTIVITY, (activity_name,))
+        if cursor.rowcount == 0:
+            # If no activity was deleted, it does not exist, return a "403 Forbidden" response
+            response = self.build_response(self.forbidden_status, b"Error", f"Activity with name {html.escape(activity_name)} does not exist".encode())
+            return response
+        # The activity does not exist anymore, so the cached check responses are outdated
+        self.invalidate_checks()
 
         # Return a "200 OK" response indicating that the activity was removed
-        response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Activity Removed", f"Activity with name {activity_name} is removed")}'.encode()
+        response = self.build_response(self.ok_status, b"Activity Removed", f"Activity with name {html.escape(activity_name)} is removed".encode())
         return response
 
     def get_check(self, query):
         # Check that the required parameters are present in the query
-        parameters_check = self.check_parameters(['name'], query)
+        parameters_check = self.check_parameters(self.name_parameters, query)
         if parameters_check:
             # If the required parameters are not present, return the error response
             return parameters_check
 
-        # Get the activity name from the query parameters
-        activity_name = query['name']
+        # Get the activity name from the query parameters, and return its check response from the cache or the database
+        return self.check_responses(query['name'], self.check_generation)
+
+    def invalidate_checks(self):
+        # Move to a new generation, so a check that was running before the change can only cache its response under the old one
+        self.check_generation += 1
+        self.check_responses.cache_clear()
 
+    def build_check_response(self, activity_name, generation):
+        # The generation is only part of the cache key
         # Get a cursor for the database connection
-        cursor = self.db.cursor()
+        cursor = self.local.cursor
 
         # Check if an activity with the given name exists
-        cursor.execute("SELECT * FROM activities WHERE name=?", (activity_name,))
+        cursor.execute(SELECT_ACTIVITY, (activity_name,))
         if cursor.fetchone() is not None:
             # If the activity exists, return a "200 OK" response indicating that the activity exists
-            response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Activity Check", f"Activity Exists")}'.encode()
+            response = self.check_exists_response
             return response
 
         else:
             # If the activity does not exist, return a "404 Not Found" response indicating that the activity does not exist
-            response = f'HTTP/1.1 404 Not Found\n\n{self.base_html.format("Activity Check", f"Activity does not exist")}'.encode()
+            response = self.check_not_found_response
             return response
 
 
-    def create_tables(self):
-        cursor = self.db.cursor()
+    def create_tables(self, db):
+        # Create the cursor once and return it, all the requests of the thread reuse it
+        cursor = db.cursor()
+        # Wait for a lock held by another connection to the same file instead of failing right away
+        cursor.execute('PRAGMA busy_timeout=5000')
+        # Use write-ahead logging so that readers do not block the writer and commits need fewer fsyncs
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-65536')
         # Create the "activities" table if it does not already exist
         cursor.execute('CREATE TABLE IF NOT EXISTS activities (name text PRIMARY KEY)')
-        self.db.commit()
+        return cursor
+
+    def build_response(self, status, title, body):
+        # Join the status line and the pre-encoded parts of the HTML template with the title and the body
+        return b''.join((status, self.html_head, title, self.html_middle, body, self.html_tail))
 
     def check_parameters(self, parameters, query):
-        # Check that each required parameter is present in the query
-        for parameter in parameters:
-            if parameter not in query:
-                # If a required parameter is not present, return an error response
-                response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", f"{parameter} parameter is mandatory")}'.encode()
-                return response
+        # Find the required parameters that are not present in the query with a single set difference
+        missing = parameters - query.keys()
+        if missing:
+            # If a required parameter is not present, return the error response of the first one in the order of required_parameters
+            return next(self.parameter_errors[parameter] for parameter in self.required_parameters if parameter in missing)
         # If all required parameters are present, return False
         return False
 
 
 
-def handle_request(server, connection):
-    try:
-        # Receive the request from the client
-        request = connection.recv(1024)
-        # Handle the request and get the response from the server
-        response = server.handle_request(request)
-        # Send the response to the client
-        connection.sendall(response)
-    finally:
-        # Close the connection
-        connection.close()
-
-
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('Usage: python main.py server_port')
@@ -182,16 +245,5 @@ if __name__ == '__main__':
     # Create an instance of the ActivityServer class
     server = ActivityServer()
 
-    # Create a TCP/IP socket and bind it to the host and server_port
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(('localhost', server_port))
-    # Start listening for incoming connections
-    sock.listen()
-
-    # Print a message indicating that the server is running on the specified port
-    print(f'{server.__class__.__name__} running on port {server_port}')
-
-    while True:
-        # Wait for a connection and pass it to the handle_request function
-        connection, _ = sock.accept()
-        handle_request(server, connection)
+    # Accept the connections and handle their requests
+    asyncio.run(serve(server, host, server_port))
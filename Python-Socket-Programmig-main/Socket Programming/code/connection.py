@@ -0,0 +1,94 @@
+import asyncio
+import functools
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds a keep-alive connection may stay idle before it is closed
+KEEP_ALIVE_TIMEOUT = 5
+
+# Largest request that is accepted, larger requests are rejected
+REQUEST_BUFFER_SIZE = 4096
+
+async def serve(server, host, port):
+    # Handle the requests on a pool of worker threads, since the database calls block
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4))
+
+    # Listen for incoming connections, with a backlog large enough to absorb bursts.
+    # Allow restarting the server on the same port right away. The port is not shared, so a second server
+    # started on it by mistake fails instead of taking part of the connections.
+    listener = await asyncio.start_server(
+        functools.partial(handle_connection, server), host, port, limit=REQUEST_BUFFER_SIZE, backlog=2048,
+        reuse_address=True)
+    print(f'{server.__class__.__name__} running on port {port}')
+
+    async with listener:
+        await listener.serve_forever()
+
+async def read_request(reader):
+    # Read the request line and the headers up to the empty line that ends them, and find if the client asks for a keep-alive connection.
+    # Lines may end with CRLF or with a bare LF, and empty lines before the request line are skipped.
+    request = b''
+    keep_alive = False
+    while True:
+        line = await reader.readuntil(b'\n')
+        if line == b'\r\n' or line == b'\n':
+            if request:
+                return request + line, keep_alive
+            continue
+        if request:
+            # Only the Connection header itself counts, its value is a comma separated list of options
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'connection':
+                keep_alive = b'keep-alive' in (option.strip().lower() for option in value.split(b','))
+        request += line
+        if len(request) > REQUEST_BUFFER_SIZE:
+            raise asyncio.LimitOverrunError('Request is too large', len(request))
+
+async def handle_connection(server, reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            # Wait for the next request, the client may send several requests on a keep-alive connection.
+            # Connections that stay idle for too long or are closed or reset by the client are closed.
+            try:
+                request, keep_alive = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+            except asyncio.LimitOverrunError:
+                # Reject a request that is larger than the limit before closing the connection
+                await send_response(writer, server.request_too_large_response)
+                return
+
+            # Handle the request on a worker thread and get the response from the server
+            try:
+                response = await loop.run_in_executor(None, server.handle_request, request)
+            except Exception:
+                # Log the failure and tell the client, instead of dropping the connection without a response
+                traceback.print_exc()
+                response = server.internal_error_response
+
+            if not keep_alive:
+                # Send the response to the client, it will be closed below
+                await send_response(writer, response)
+                return
+
+            # Add the length of the body, so the client knows where the response ends, and keep the connection open.
+            # The status line, the headers and the body are handed to the transport as separate buffers, without copying them into one.
+            end = response.index(b'\r\n\r\n')
+            view = memoryview(response)
+            if not await send_response(writer, view[:end], b'\r\nContent-Length: %d\r\nConnection: keep-alive\r\n\r\n' % (len(response) - end - 4), view[end+4:]):
+                return
+    finally:
+        # Close the connection
+        writer.close()
+
+async def send_response(writer, *parts):
+    # Send the parts of a response to the client, returns False if the client closed or reset the connection
+    try:
+        writer.writelines(parts)
+        await writer.drain()
+    except ConnectionError:
+        return False
+    return True
@@ -1,35 +1,14 @@
-import socket
+import asyncio
 import sys
 from threading import Thread
+from connection import serve
 from room_server import RoomServer
 from activity_server import ActivityServer
 from reservation_server import ReservationServer
 
 def start_server(server, port):
-    # Create a socket and bind it to the specified port
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(('localhost', port))
-    # Listen for incoming connections
-    sock.listen()
-    print(f'{server.__class__.__name__} running on port {port}')
-
-    while True:
-        # Accept incoming connections
-        connection, _ = sock.accept()
-        # Handle the request on a separate thread
-        handle_request(server, connection)
-
-def handle_request(server, connection):
-    try:
-        # Receive the request from the client
-        request = connection.recv(1024)
-        # Process the request and get a response from the server
-        response = server.handle_request(request)
-        # Send the response back to the client
-        connection.sendall(response)
-    finally:
-        # Close the connection
-        connection.close()
+    # Run the server on its own event loop, it handles all of its connections
+    asyncio.run(serve(server, 'localhost', port))
 
 def main():
     if len(sys.argv) < 4:
@@ -48,9 +27,17 @@ def main():
     reservation_server = ReservationServer(host, room_server_port, activity_server_port)
 
     # Start a new thread for each server and start listening for incoming connections
-    Thread(target=start_server, args=(room_server, room_server_port)).start()
-    Thread(target=start_server, args=(activity_server, activity_server_port)).start()
-    Thread(target=start_server, args=(reservation_server, reservation_server_port)).start()
+    threads = [
+        Thread(target=start_server, args=(room_server, room_server_port)),
+        Thread(target=start_server, args=(activity_server, activity_server_port)),
+        Thread(target=start_server, args=(reservation_server, reservation_server_port)),
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Keep the main thread alive, otherwise the worker pools refuse new work once it exits
+    for thread in threads:
+        thread.join()
 
 if __name__ == '__main__':
     main()
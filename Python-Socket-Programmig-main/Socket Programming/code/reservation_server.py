@@ -1,14 +1,51 @@
+import asyncio
+import functools
+import html
+import queue
 import socket
 import sqlite3
 import re
 import sys
+import threading
+import traceback
+from urllib.parse import parse_qsl, urlencode
+from connection import serve
+
+# Queries used while handling requests. Keeping them as constants lets sqlite reuse their prepared statements.
+INSERT_RESERVATION = "INSERT INTO reservations (room, activity, day, hour, duration) VALUES (?, ?, ?, ?, ?)"
+SELECT_RESERVATION = "SELECT * FROM reservations WHERE id=?"
+
+# Matches the body of a response from the room server
+BODY_RE = re.compile(rb'<BODY>(.*?)</BODY>', re.DOTALL)
+
+def build_requests(sub_urls):
+    # Build a keep-alive GET request for each of the sub-urls, all of them are written to a connection at once
+    return ''.join(f'GET {sub_url} HTTP/1.1\r\nConnection: keep-alive\r\n\r\n' for sub_url in sub_urls).encode()
+
+@functools.lru_cache(maxsize=256)
+def build_availability_request(room_name, day=None):
+    # Build the request for the availability of a room on one day, or on the whole week if no day is given.
+    # The same rooms are queried again and again, so the requests are built once and cached.
+    if day is None:
+        return build_requests(['/checkweekavailability?' + urlencode({'name': room_name})])
+    return build_requests(['/checkavailability?' + urlencode({'name': room_name, 'day': day})])
 
 class ReservationServer:
-    # List of accepted sub-URLs that the server can handle
-    accepted_sub_urls = ['/reserve', '/listavailability', '/display']
+    # Set of accepted sub-URLs that the server can handle
+    accepted_sub_urls = frozenset({'/reserve', '/listavailability', '/display'})
+    # Parameters that the sub-URLs require
+    required_parameters = ('activity', 'room', 'day', 'hour', 'duration', 'id')
+    # Sets of the parameters that each sub-URL requires
+    reserve_parameters = frozenset({'activity', 'room', 'day', 'hour', 'duration'})
+    listavailability_parameters = frozenset({'room'})
+    display_parameters = frozenset({'id'})
 
     # This is a list of the names of the days of the week.
     day_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    # The pre-encoded start of the availability line of each day
+    day_prefixes = tuple(f'For {day_name}: '.encode() for day_name in day_names)
+    # The numbers of all the days of the week
+    week_days = (1, 2, 3, 4, 5, 6, 7)
 
     # HTML template for responses
     base_html = """<HTML>
@@ -18,97 +55,146 @@ class ReservationServer:
 <BODY>{}</BODY>
 </HTML>"""
 
+    # The pre-encoded parts of the HTML template around the title and the body
+    html_head, html_middle, html_tail = (part.encode() for part in base_html.split('{}'))
+
+    # Pre-encoded status lines of the responses
+    ok_status = b'HTTP/1.1 200 OK\r\n\r\n'
+    bad_request_status = b'HTTP/1.1 400 Bad Request\r\n\r\n'
+    internal_error_status = b'HTTP/1.1 500 Internal Server Error\r\n\r\n'
+    bad_gateway_status = b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
+    invalid_url_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid URL", html_tail))
+    request_too_large_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Request too large", html_tail))
+    internal_error_response = b''.join((internal_error_status, html_head, b"Error", html_middle, b"Internal server error", html_tail))
+    bad_gateway_response = b''.join((bad_gateway_status, html_head, b"Error", html_middle, b"Room or activity server is unavailable", html_tail))
+    invalid_day_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid day paramater", html_tail))
+    # The same 400 Bad Request responses the room server gives for invalid reservation parameters
+    reserve_invalid_day_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid day parameter", html_tail))
+    invalid_hour_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid hour parameter", html_tail))
+    invalid_duration_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid duration parameter", html_tail))
+
     def __init__(self, host, room_server_port, activity_server_port):
         # This is the constructor for the ReservationServer class. It initializes the host, room_server_port, and activity_server_port.
         self.host = host
         self.room_server_port = room_server_port
         self.activity_server_port = activity_server_port
 
-        self.db = None
-        # The self.db variable will be used to store the connection to the database. It is initialized as None.
+        self.local = threading.local()
+        # Each worker thread keeps its own connection to the database in self.local, so the threads can read at the same time.
+        self.lock = threading.Lock()
+        # The self.lock variable is used to make sure only one thread writes to the database at a time.
+        # The calls to the room and activity servers are made outside of it so they do not block other clients.
+
+        # Pools of open keep-alive connections to the room and activity servers, so every call does not need a new connection
+        self.connection_pools = {room_server_port: queue.Queue(), activity_server_port: queue.Queue()}
+
+        # Maps each accepted sub-URL to the method that handles it
+        self.routes = {
+            '/reserve': self.get_reserve,
+            '/listavailability': self.get_listavailability,
+            '/display': self.get_display,
+        }
+
+        # Error responses for each missing parameter, built once so a bad request only needs a lookup
+        self.parameter_errors = {
+            parameter: self.build_response(self.bad_request_status, b"Error", f"{parameter} parameter is mandatory".encode())
+            for parameter in self.required_parameters
+        }
 
     def handle_request(self, request):
-        # If the database connection has not been established, create it and the tables
-        if self.db is None:
-            self.db = sqlite3.connect('reservation.db')
-            self.create_tables()
+        # If this worker thread has not connected to the database yet, create its connection and the tables
+        if not hasattr(self.local, 'db'):
+            db = sqlite3.connect('reservation.db', isolation_level=None, cached_statements=256)
+            cursor = self.create_tables(db)
+            # Keep the connection only once the tables are ready, so if creating them fails the next request tries again
+            self.local.db, self.local.cursor = db, cursor
 
         # Parse the request and get the sub-URL and query parameters
-        sub_url, query = self.parse_request(request)
-
-        # Call the appropriate method based on the sub-URL
-        if sub_url == '/reserve':
-            response = self.get_reserve(query)
-        elif sub_url == '/listavailability':
-            response = self.get_listavailability(query)
-        elif sub_url == '/display':
-            response = self.get_display(query)
+        try:
+            sub_url, query = self.parse_request(request)
+        except (IndexError, UnicodeDecodeError):
+            # If the request line is malformed, return a Bad Request error
+            return self.invalid_url_response
+
+        # Look up the method for the sub-URL and call it
+        handler = self.routes.get(sub_url)
+        if handler is not None:
+            try:
+                response = handler(query)
+            except OSError:
+                # The room or activity server could not be reached or failed while answering, log it and return a Bad Gateway error
+                traceback.print_exc()
+                response = self.bad_gateway_response
         else:
-            # If the sub-url is not in the list of accepted sub-urls, return a Bad Request error.
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Invalid URL")}'.encode()
+            # If the sub-url is not in the set of accepted sub-urls, return a Bad Request error.
+            response = self.invalid_url_response
 
         return response
 
     def parse_request(self, request):
         # This method parses the request to get the sub-url and the query parameters.
-        # Split the request by spaces and get the second element, which is the URL. Decode it to get a string.
-        url = request.split(b' ', 2)[1].decode()
+        # Split the request by spaces and get the second element, which is the URL
+        url = request.split(b' ', 2)[1]
 
-        #Split the URL by the '?' character to separate the sub-url from the query parameters. The sub-url is the first element.
-        sub_url = url.split('?')[0]
+        # Split the URL into the sub-url, which is its path, and the query string.
+        # This is done on the bytes, only the two short parts are decoded to strings.
+        path, _, query_string = url.partition(b'?')
+        sub_url = path.decode()
         if not sub_url in self.accepted_sub_urls:
-            # If the sub-URL is not in the list of accepted sub-URLs, return it
+            # If the sub-URL is not in the set of accepted sub-URLs, return it
             return sub_url, False
 
-        # Use a dictionary comprehension to create a dictionary where the keys are the parameter names and the values are the parameter values.
-        # Split the query string by '&' to get a list of individual parameters.
-        query = {param.split('=')[0]: param.split('=')[1] for param in url.split('?')[1].split('&')}
+        # Create a dictionary where the keys are the parameter names and the values are the parameter values.
+        query = dict(parse_qsl(query_string.decode(), keep_blank_values=True))
         return sub_url, query
 
     def get_reserve(self, query):
         # Check if required parameters are present in the query dictionary
-        parameters_check = self.check_parameters(['activity', 'room', 'day', 'hour', 'duration'], query)
+        parameters_check = self.check_parameters(self.reserve_parameters, query)
         if parameters_check:
             return parameters_check
 
         activity_name = query['activity']
-        # Connect to the activity server and check if the specified activity exists
-        activity_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        activity_server_socket.connect((self.host, self.activity_server_port))
-        activity_server_socket.sendall(f'GET /check?name={activity_name} HTTP/1.1\n\n'.encode())
-        activity_server_response = activity_server_socket.recv(1024).decode('utf-8')
+        # Ask the activity server if the specified activity exists
+        activity_server_response, = self.send_requests(
+            self.activity_server_port, build_requests(['/check?' + urlencode({'name': activity_name})]), 1)
 
         # If the activity does not exist, return the 404 Not Found error
-        if '404 Not Found' in activity_server_response: return activity_server_response.encode()
+        if b'404 Not Found' in activity_server_response: return activity_server_response
 
         room_name = query['room']
-        day = query['day']
-        hour = query['hour']
-        duration = query['duration']
-        # Connect to the room server and attempt to reserve the specified room
-        room_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        room_server_socket.connect((self.host, self.room_server_port))
-        room_server_socket.sendall(
-            f'GET /reserve?name={room_name}&day={day}&hour={hour}&duration={duration} HTTP/1.1\n\n'.encode())
-        room_server_response = room_server_socket.recv(1024).decode('utf-8')
+        # Convert the numbers once, so the integers are sent to the room server and stored.
+        # A value that is not a number is None and is rejected like a value out of range, without calling the room server.
+        day = self.parse_number(query['day'])
+        hour = self.parse_number(query['hour'])
+        duration = self.parse_number(query['duration'])
+        if day is None or not 1 <= day <= 7:
+            return self.reserve_invalid_day_response
+        if hour is None or not 9 <= hour <= 17:
+            return self.invalid_hour_response
+        if duration is None or duration < 1 or hour + duration > 18:
+            return self.invalid_duration_response
+
+        # Attempt to reserve the specified room on the room server
+        room_server_response, = self.send_requests(
+            self.room_server_port,
+            build_requests(['/reserve?' + urlencode({'name': room_name, 'day': day, 'hour': hour, 'duration': duration})]), 1)
         # If the room reservation fails, return the error message
-        if '400 Bad Request' in room_server_response or '403 Forbidden' in room_server_response: return room_server_response.encode()
+        if b'400 Bad Request' in room_server_response or b'403 Forbidden' in room_server_response: return room_server_response
 
-        cursor = self.db.cursor()
-        # Insert the reservation into the database
-        cursor.execute(
-            '''INSERT INTO reservations (room, activity, day, hour, duration) VALUES (?, ?, ?, ?, ?)''',
-            (room_name, activity_name, day, hour, duration))
-        self.db.commit()
-        reservation_id = cursor.lastrowid
+        with self.lock:
+            cursor = self.local.cursor
+            # Insert the reservation into the database
+            cursor.execute(INSERT_RESERVATION, (room_name, activity_name, day, hour, duration))
+            reservation_id = cursor.lastrowid
 
         # Return a message indicating that the reservation was successful, along with the reservation ID
-        response = f'HTTP/1.1 200 Bad Request\n\n{self.base_html.format("Reservation Succesfull", f"Reservation ID: {reservation_id}")}'.encode()
+        response = self.build_response(self.ok_status, b"Reservation Succesfull", f"Reservation ID: {reservation_id}".encode())
         return response
 
     def get_listavailability(self, query):
         # Check if the required "room" parameter is present in the query dictionary
-        parameters_check = self.check_parameters(['room'], query)
+        parameters_check = self.check_parameters(self.listavailability_parameters, query)
         if parameters_check:
             return parameters_check
 
@@ -116,51 +202,51 @@ class ReservationServer:
 
         # If the "day" parameter is present, only check availability for that day
         if 'day' in query:
-            day = int(query['day'])
-            request_strings = [(f'GET /checkavailability?name={room_name}&day={day} HTTP/1.1\n\n', self.day_names[day-1])]
-        # If the "day" parameter is not present, check availability for all days of the week
+            try:
+                days = (int(query['day']),)
+            except ValueError:
+                # If the day is not a number, return the same 400 Bad Request response the room server gives for an invalid day
+                return self.invalid_day_response
+            request = build_availability_request(room_name, days[0])
+        # If the "day" parameter is not present, check availability for all days of the week with a single request
         else:
-            request_strings = [(f'GET /checkavailability?name={room_name}&day={i} HTTP/1.1\n\n', self.day_names[i-1]) for i in range(1,8)]
-
-        response_string = ''
-        # Iterate through each day and request availability from the room server
-        for i, (request_string, day) in enumerate(request_strings):
-            room_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            room_server_socket.connect(('localhost', self.room_server_port))
-            room_server_socket.sendall(request_string.encode())
-            room_server_response = room_server_socket.recv(1024).decode('utf-8')
-            room_server_socket.close()
-
-            # If the room server returns a 404 Not Found or 400 Bad Request error, return the error message
-            if '404 Not Found' in room_server_response or '400 Bad Request' in room_server_response:
-                return room_server_response.encode()
-
-            # Extract the availability information from the room server's response
-            body = re.search('<BODY>(.*)</BODY>', room_server_response).group(1)
-            # Add the availability information to the response string
-            response_string += f'For {day}: {body}<br></br>'
+            days = self.week_days
+            request = build_availability_request(room_name)
+
+        room_server_response, = self.send_requests(self.room_server_port, request, 1)
+        # If the room server returns a 404 Not Found or 400 Bad Request error, return the error message
+        if b'404 Not Found' in room_server_response or b'400 Bad Request' in room_server_response:
+            return room_server_response
+
+        # Extract the availability information from the room server's response, the days are separated by line breaks
+        bodies = BODY_RE.search(room_server_response).group(1).split(b'<br></br>')
+        # Add the availability information of each day to the response string
+        response_string = b''.join(
+            b'%b%b<br></br>' % (self.day_prefixes[day-1], body) for day, body in zip(days, bodies))
 
         # Return an HTML page with the availability information for each day
-        response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Availabilities", response_string)}'.encode()
+        response = self.build_response(self.ok_status, b"Availabilities", response_string)
         return response
 
     def get_display(self, query):
         # Check if the required "id" parameter is present in the query dictionary
-        parameters_check = self.check_parameters(['id'], query)
+        parameters_check = self.check_parameters(self.display_parameters, query)
         if parameters_check:
             return parameters_check
         # Get the reservations for the specified reservation ID
         reservation_id = query['id']
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT * FROM reservations WHERE id=?''', (reservation_id,))
+        # Reading does not need the lock, the thread uses its own connection
+        cursor = self.local.cursor
+        cursor.execute(SELECT_RESERVATION, (reservation_id,))
         reservation = cursor.fetchone()
         if reservation is None:
             # Reservation does not exist, return a 404 Not Found response
-            return b'HTTP/1.1 404 Not Found'
+            return b'HTTP/1.1 404 Not Found\r\n\r\n'
 
         # Create an HTML page with the reservation details
-        room_name = reservation[1]
-        activity_name = reservation[2]
+        # The names come from the clients, escape them so they are shown as text
+        room_name = html.escape(reservation[1])
+        activity_name = html.escape(reservation[2])
         day = reservation[3]
         hour = reservation[4]
         duration = reservation[5]
@@ -173,12 +259,20 @@ class ReservationServer:
         <p>Duration: {duration} hours</p>
         '''
 
-        response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Reservation Info", body)}'.encode()
+        response = self.build_response(self.ok_status, b"Reservation Info", body.encode())
         return response
 
-    def create_tables(self):
+    def create_tables(self, db):
+        # Create the cursor once and return it, all the requests of the thread reuse it
+        cursor = db.cursor()
+        # Wait for a lock held by another connection to the same file instead of failing right away
+        cursor.execute('PRAGMA busy_timeout=5000')
+        # Use write-ahead logging so that readers do not block the writer and commits need fewer fsyncs
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-65536')
         # Create the "reservations" table in the database if it does not already exist
-        cursor = self.db.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS reservations (
                 id INTEGER PRIMARY KEY,
@@ -189,32 +283,95 @@ class ReservationServer:
                 duration INTEGER NOT NULL
             )
         ''')
-        self.db.commit()
+        return cursor
+
+    def send_requests(self, port, requests, count):
+        # Send the given number of requests to the server on the given port and return the responses.
+        # All requests are written at once on a keep-alive connection and the server answers them in order.
+        while True:
+            connection, pooled = self.acquire_connection(port)
+            server_socket, reader = connection
+            try:
+                server_socket.sendall(requests)
+                # Wait for the first byte of the responses, nothing is returned if the server closed the connection
+                if not reader.peek(1):
+                    raise ConnectionError('Connection closed by the server')
+            except OSError:
+                server_socket.close()
+                # A pooled connection may have been closed by the server in the meantime, before it read the requests.
+                # Nothing was answered on it, so the requests are sent again on the next connection.
+                if pooled:
+                    continue
+                raise
+
+            try:
+                responses = [self.read_response(reader) for _ in range(count)]
+            except OSError:
+                # The server started answering, so the requests may have been handled. They are not sent again,
+                # since a reservation must not be made twice.
+                server_socket.close()
+                raise
+            self.release_connection(port, connection)
+            return responses
+
+    def acquire_connection(self, port):
+        # Take an open connection to the server on the given port from the pool, or create one if there is none.
+        # Also returns whether the connection came from the pool.
+        try:
+            return self.connection_pools[port].get_nowait(), True
+        except queue.Empty:
+            pass
+
+        server_socket = socket.create_connection((self.host, port))
+        # Send the small requests immediately instead of waiting to fill a packet
+        server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return (server_socket, server_socket.makefile('rb')), False
+
+    def release_connection(self, port, connection):
+        # Put the connection back to the pool so the next request can reuse it
+        self.connection_pools[port].put(connection)
+
+    def read_response(self, reader):
+        # Read the status line of the response
+        status = reader.readline()
+        if not status:
+            raise ConnectionError('Connection closed by the server')
+
+        # Read the headers until the empty line and find the length of the body
+        content_length = 0
+        while True:
+            line = reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                content_length = int(value)
+
+        # Read the body and return the response in the same form the servers create it
+        body = reader.read(content_length)
+        return status.rstrip() + b'\r\n\r\n' + body
+
+    def build_response(self, status, title, body):
+        # Join the status line and the pre-encoded parts of the HTML template with the title and the body
+        return b''.join((status, self.html_head, title, self.html_middle, body, self.html_tail))
+
+    def parse_number(self, value):
+        # Convert a parameter to an integer, or return None if it is not a number
+        try:
+            return int(value)
+        except ValueError:
+            return None
 
     def check_parameters(self, parameters, query):
-        # Check that each required parameter is present in the query
-        for parameter in parameters:
-            if parameter not in query:
-                # If a required parameter is not present, return an error response
-                response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", f"{parameter} parameter is mandatory")}'.encode()
-                return response
+        # Find the required parameters that are not present in the query with a single set difference
+        missing = parameters - query.keys()
+        if missing:
+            # If a required parameter is not present, return the error response of the first one in the order of required_parameters
+            return next(self.parameter_errors[parameter] for parameter in self.required_parameters if parameter in missing)
         # If all required parameters are present, return False
         return False
 
 
-def handle_request(server, connection):
-    try:
-        # Receive the request from the client
-        request = connection.recv(1024)
-        # Handle the request and get the response from the server
-        response = server.handle_request(request)
-        # Send the response to the client
-        connection.sendall(response)
-    finally:
-        # Close the connection
-        connection.close()
-
-
 if __name__ == '__main__':
     if len(sys.argv) < 4:
         print('Usage: python main.py room_server_port activity_server_port reservation_server_port')
@@ -227,11 +384,5 @@ if __name__ == '__main__':
 
     server = ReservationServer(host, room_server_port, activity_server_port)
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(('localhost', reservation_server_port))
-    sock.listen()
-    print(f'{server.__class__.__name__} running on port {reservation_server_port}')
-
-    while True:
-        connection, _ = sock.accept()
-        handle_request(server, connection)
+    # Accept the connections and handle their requests
+    asyncio.run(serve(server, host, reservation_server_port))
@@ -1,11 +1,41 @@
+import asyncio
+import html
 import sqlite3
-import socket
 import sys
+import threading
+from urllib.parse import parse_qsl
+from connection import serve
+
+# Queries used while handling requests. Keeping them as constants lets sqlite reuse their prepared statements.
+INSERT_ROOM = "INSERT INTO rooms (name) VALUES (?) ON CONFLICT DO NOTHING"
+DELETE_ROOM = "DELETE FROM rooms WHERE name=?"
+SELECT_ROOM = "SELECT 1 FROM rooms WHERE name=? LIMIT 1"
+SELECT_RESERVED_HOUR = "SELECT hour FROM reservations WHERE name=? AND day=? AND hour BETWEEN ? AND ? ORDER BY hour LIMIT 1"
+INSERT_RESERVATION = "INSERT INTO reservations (name, day, hour) VALUES (?, ?, ?)"
+SELECT_WEEK_RESERVED_MASKS = "SELECT day, TOTAL(DISTINCT 1 << (hour - 9)) FROM reservations WHERE name=? GROUP BY day"
+SELECT_ROOMS = "SELECT name FROM rooms"
+SELECT_RESERVED_MASKS = "SELECT name, day, TOTAL(DISTINCT 1 << (hour - 9)) FROM reservations GROUP BY name, day"
+
+# The hours of a day are stored as bits of a mask, hour 9 is the lowest bit and hour 17 the highest
+FULL_DAY_MASK = 0x1FF
+# The availability text of every possible mask of available hours, built once so formatting only needs a lookup
+AVAILABILITY_STRINGS = tuple(
+    f"The following hours are available: {',  '.join(str(hour) for hour in range(9, 18) if mask >> (hour - 9) & 1)}".encode()
+    for mask in range(FULL_DAY_MASK + 1)
+)
 
 class RoomServer:
 
-    # List of accepted sub-URLs that the server can handle
-    accepted_sub_urls = ['/add', '/remove', '/reserve', '/checkavailability']
+    # Set of accepted sub-URLs that the server can handle
+    accepted_sub_urls = frozenset({'/add', '/remove', '/reserve', '/checkavailability', '/checkweekavailability'})
+    # Parameters that the sub-URLs require
+    required_parameters = ('name', 'day', 'hour', 'duration')
+    # Sub-URLs that change the database, they are handled one at a time under the lock
+    write_sub_urls = frozenset({'/add', '/remove', '/reserve'})
+    # Sets of the parameters that each sub-URL requires
+    name_parameters = frozenset({'name'})
+    reserve_parameters = frozenset({'name', 'day', 'hour', 'duration'})
+    availability_parameters = frozenset({'name', 'day'})
 
     # HTML template for responses
     base_html = """<HTML>
@@ -15,199 +45,352 @@ class RoomServer:
 <BODY>{}</BODY>
 </HTML>"""
 
+    # The pre-encoded parts of the HTML template around the title and the body
+    html_head, html_middle, html_tail = (part.encode() for part in base_html.split('{}'))
+
+    # Pre-encoded status lines of the responses
+    ok_status = b'HTTP/1.1 200 OK\r\n\r\n'
+    bad_request_status = b'HTTP/1.1 400 Bad Request\r\n\r\n'
+    forbidden_status = b'HTTP/1.1 403 Forbidden\r\n\r\n'
+    internal_error_status = b'HTTP/1.1 500 Internal Server Error\r\n\r\n'
+    invalid_url_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid URL", html_tail))
+    request_too_large_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Request too large", html_tail))
+    internal_error_response = b''.join((internal_error_status, html_head, b"Error", html_middle, b"Internal server error", html_tail))
+
+    # Responses whose content never changes, built once so these paths only return them
+    room_exists_response = b''.join((forbidden_status, html_head, b"Error", html_middle, b"Room already exists", html_tail))
+    room_not_found_response = b''.join((forbidden_status, html_head, b"Error", html_middle, b"Room does not exist", html_tail))
+    invalid_day_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid day parameter", html_tail))
+    invalid_hour_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid hour parameter", html_tail))
+    invalid_duration_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid duration parameter", html_tail))
+    reserve_room_not_found_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Room does not exist", html_tail))
+    check_room_not_found_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Room Does not exist", html_tail))
+    check_invalid_day_response = b''.join((bad_request_status, html_head, b"Error", html_middle, b"Invalid day paramater", html_tail))
+
 
     def __init__(self):
-        # The self.db variable will be used to store the connection to the database. It is initialized as None.
-        self.db = None
+        # Each worker thread keeps its own connection to the database in self.local, so the threads can read at the same time
+        self.local = threading.local()
+        # The self.lock variable is used to make sure only one thread writes to the database at a time.
+        self.lock = threading.Lock()
+
+        # Maps each accepted sub-URL to the method that handles it
+        self.routes = {
+            '/add': self.get_add,
+            '/remove': self.get_remove,
+            '/reserve': self.get_reserve,
+            '/checkavailability': self.get_check_availability,
+            '/checkweekavailability': self.get_check_week_availability,
+        }
+
+        # The reserved hours of every room, kept in memory so checking the availability does not query the database.
+        # Each room has a list of masks indexed by the day (1-7). The database stays the durable copy, the masks are loaded from it once.
+        # The server runs as a single process and must be the only one using room.db, changes made by another process are not seen here.
+        self.rooms = None
+
+        # Availability responses that were already built, keyed by (room name, day) for a day and by the room name for the whole week.
+        # The responses of a room are removed when it is reserved or removed, and the generation changes at the same time,
+        # so a response that was built from the old reservations is not stored.
+        self.availability_responses = {}
+        self.availability_generation = 0
+        self.availability_lock = threading.Lock()
+
+        # Error responses for each missing parameter, built once so a bad request only needs a lookup
+        self.parameter_errors = {
+            parameter: self.build_response(self.bad_request_status, b"Error", f"{parameter} parameter is mandatory".encode())
+            for parameter in self.required_parameters
+        }
+        # Responses for a reservation that clashes with an already reserved hour, built once for each hour (9-17)
+        self.reserved_errors = {
+            hour: self.build_response(self.forbidden_status, b"Error", f"Room is already reserved at {hour}".encode())
+            for hour in range(9, 18)
+        }
 
     def handle_request(self, request):
-        # If the database connection has not been established, create it and the tables
-        if self.db is None:
-            self.db = sqlite3.connect('room.db')
-            self.create_tables()
-
-        # Parse the request and get the sub-URL and query parameters
-        sub_url, query = self.parse_request(request)
-
-        # Call the appropriate method based on the sub-URL
-        if sub_url == '/add':
-            response = self.get_add(query)
-        elif sub_url == '/remove':
-            response = self.get_remove(query)
-        elif sub_url == '/reserve':
-            response = self.get_reserve(query)
-        elif sub_url == '/checkavailability':
-            response = self.get_check_availability(query)
-        else:
-            # If the sub-url is not in the list of accepted sub-urls, return a Bad Request error.
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Invalid URL")}'.encode()
-
-        return response
+        # Parse the request and get the sub-URL and query parameters.
+        # Parsing does not touch the database, so the worker threads do it in parallel outside of the lock.
+        try:
+            sub_url, query = self.parse_request(request)
+        except (IndexError, UnicodeDecodeError):
+            # If the request line is malformed, return a Bad Request error
+            return self.invalid_url_response
+
+        # Look up the method for the sub-URL
+        handler = self.routes.get(sub_url)
+        if handler is None:
+            # If the sub-url is not in the set of accepted sub-urls, return a Bad Request error.
+            return self.invalid_url_response
+
+        # If this worker thread has not connected to the database yet, create its connection and the tables
+        if not hasattr(self.local, 'db'):
+            db = sqlite3.connect('room.db', isolation_level=None, cached_statements=256)
+            cursor = self.create_tables(db)
+            # Keep the connection only once the tables are ready, so if creating them fails the next request tries again
+            self.local.db, self.local.cursor = db, cursor
+
+        # Load the rooms and their reservations into memory the first time a request is handled
+        if self.rooms is None:
+            with self.lock:
+                if self.rooms is None:
+                    self.load_rooms()
+
+        # Call the method for the sub-URL, the requests that change the database are handled under the lock
+        if sub_url in self.write_sub_urls:
+            with self.lock:
+                return handler(query)
+        return handler(query)
 
     def parse_request(self, request):
         # This method parses the request to get the sub-url and the query parameters.
-        # Split the request by spaces and get the second element, which is the URL. Decode it to get a string.
-        url = request.split(b' ', 2)[1].decode()
+        # Split the request by spaces and get the second element, which is the URL
+        url = request.split(b' ', 2)[1]
 
-        #Split the URL by the '?' character to separate the sub-url from the query parameters. The sub-url is the first element
-        sub_url = url.split('?')[0]
+        # Split the URL into the sub-url, which is its path, and the query string.
+        # This is done on the bytes, only the two short parts are decoded to strings.
+        path, _, query_string = url.partition(b'?')
+        sub_url = path.decode()
         if not sub_url in self.accepted_sub_urls:
-            # If the sub-URL is not in the list of accepted sub-URLs, return it
+            # If the sub-URL is not in the set of accepted sub-URLs, return it
             return sub_url, False
 
-        # Use a dictionary comprehension to create a dictionary where the keys are the parameter names and the values are the parameter values.
-        # Split the query string by '&' to get a list of individual parameters.
-        query = {param.split('=')[0]:param.split('=')[1] for param in url.split('?')[1].split('&')}
+        # Create a dictionary where the keys are the parameter names and the values are the parameter values.
+        query = dict(parse_qsl(query_string.decode(), keep_blank_values=True))
         return sub_url, query
 
     def get_add(self, query):
         # Check that the required parameters are present in the query
-        parameters_check = self.check_parameters(['name'], query)
+        parameters_check = self.check_parameters(self.name_parameters, query)
         if parameters_check:
             return parameters_check
 
         # Get the name of the room to add
         room_name = query['name']
-        cursor = self.db.cursor()
-        # Check if a room with the same name already exists
-        cursor.execute("SELECT * FROM rooms WHERE name=?", (room_name,))
-        if cursor.fetchone() is not None:
+        cursor = self.local.cursor
+        # Insert a new row into the rooms table with the given name, nothing is inserted if a room with the same name already exists
+        cursor.execute(INSERT_ROOM, (room_name,))
+        if cursor.rowcount == 0:
             # If a room with the same name already exists, return a "403 Forbidden" response
-            response = f'HTTP/1.1 403 Forbidden\n\n{self.base_html.format("Error", "Room already exists")}'.encode()
+            response = self.room_exists_response
             return response
-
-        # Insert a new row into the rooms table with the given name
-        cursor.execute("INSERT INTO rooms (name) VALUES (?)", (room_name,))
-        self.db.commit()
+        # Add the room to memory, with the reservations that may have been left from a room with the same name
+        cursor.execute(SELECT_WEEK_RESERVED_MASKS, (room_name,))
+        masks = [0] * 8
+        for day, mask in cursor.fetchall():
+            masks[day] = int(mask)
+        self.rooms[room_name] = masks
 
         # Return a "200 OK" response
-        response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Room Added", f"Room with name {room_name} is successfully added.")}'.encode()
+        response = self.build_response(self.ok_status, b"Room Added", f"Room with name {html.escape(room_name)} is successfully added.".encode())
         return response
 
     def get_remove(self, query):
         # Check that the required parameters are present in the query
-        parameters_check = self.check_parameters(['name'], query)
+        parameters_check = self.check_parameters(self.name_parameters, query)
         if parameters_check:
             return parameters_check
 
         # Get the name of the room to remove
         room_name = query['name']
-        cursor = self.db.cursor()
-        # Check if a room with the given name exists
-        cursor.execute("SELECT * FROM rooms WHERE name=?", (room_name,))
-        if cursor.fetchone() is None:
-            # If a room with the given name does not exist, return a "403 Forbidden" response
-            response = f'HTTP/1.1 403 Forbidden\n\n{self.base_html.format("Error", "Room does not exist")}'.encode()
-            return response
-
+        cursor = self.local.cursor
         # Delete the row from the rooms table with the given name
-        cursor.execute("DELETE FROM rooms WHERE name=?", (room_name,))
-        self.db.commit()
+        cursor.execute(DELETE_ROOM, (room_name,))
+        if cursor.rowcount == 0:
+            # If no row was deleted, the room does not exist, return a "403 Forbidden" response
+            response = self.room_not_found_response
+            return response
+        # Remove the room from memory, its cached availability is outdated
+        self.rooms.pop(room_name, None)
+        self.invalidate_availability(room_name, range(1, 8))
 
         # Return a "200 OK" response
-        response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Room Removed", f"Room with name {room_name} is successfully removed")}'.encode()
+        response = self.build_response(self.ok_status, b"Room Removed", f"Room with name {html.escape(room_name)} is successfully removed".encode())
         return response
 
     def get_reserve(self, query):
         # Check if all required parameters are present in the query dictionary
-        parameters_check = self.check_parameters(['name', 'day', 'hour', 'duration'], query)
+        parameters_check = self.check_parameters(self.reserve_parameters, query)
         if parameters_check:
             return parameters_check
 
         room_name = query['name']
-        day = int(query['day'])
-        hour = int(query['hour'])
-        duration = int(query['duration'])
+        # Convert the numbers once, a value that is not a number is None and is rejected like a value out of range
+        day = self.parse_number(query['day'])
+        hour = self.parse_number(query['hour'])
+        duration = self.parse_number(query['duration'])
 
         # Check if the specified day is a valid day of the week
-        if not 1 <= day <= 7:
+        if day is None or not 1 <= day <= 7:
             # If the day is not a valid day of the week, return a 400 Bad Request response
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Invalid day parameter")}'.encode()
+            response = self.invalid_day_response
             return response
         # Check if the specified hour is a valid hour of the day
-        if not 9 <= hour <= 17:
+        if hour is None or not 9 <= hour <= 17:
             # If the hour is not a valid hour of the day, return a 400 Bad Request response
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Invalid hour parameter")}'.encode()
+            response = self.invalid_hour_response
             return response
         # Check if the duration is valid for the specified hour
-        if hour + duration > 18:
+        if duration is None or duration < 1 or hour + duration > 18:
             # If the duration is not valid, return a 400 Bad Request response
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Invalid duration parameter")}'.encode()
+            response = self.invalid_duration_response
             return response
 
-        # Get a cursor for the database
-        cursor = self.db.cursor()
-        # Check if the specified room exists in the database
-        cursor.execute("SELECT * FROM rooms WHERE name=?", (room_name,))
-        if cursor.fetchone() is None:
+        # Check the room and the requested hours in memory first, so a reservation that cannot be made does not touch the database
+        masks = self.rooms.get(room_name)
+        if masks is None:
             # If the room does not exist, return a 400 Bad Request response
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Room does not exist")}'.encode()
+            response = self.reserve_room_not_found_response
+            return response
+        requested_mask = ((1 << duration) - 1) << (hour - 9)
+        reserved_mask = masks[day] & requested_mask
+        if reserved_mask:
+            # If the room is already reserved at any of the specified hours, return a 403 Forbidden response with the first of them
+            reserved_hour = (reserved_mask & -reserved_mask).bit_length() + 8
+            response = self.reserved_errors[reserved_hour]
             return response
 
-        # Check if the room is already reserved for any of the hours in the duration
-        for d in range(duration):
-            cursor.execute("SELECT * FROM reservations WHERE name=? AND day=? AND hour=?", (room_name, day, hour+d))
-            if cursor.fetchone() is not None:
-                # If the room is already reserved at any of the specified hours, return a 403 Forbidden response
-                response = f'HTTP/1.1 403 Forbidden\n\n{self.base_html.format("Error", f"Room is already reserved at {hour+d}")}'.encode()
-                return response
-
-            # If all checks pass, reserve the room for the specified duration
-            for d in range(duration):
-                cursor.execute("INSERT INTO reservations (name, day, hour) VALUES (?, ?, ?)", (room_name, day, hour+d))
-                self.db.commit()
-
-            # Return a 200 OK response to confirm that the reservation was successful
-            response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Reservation Successful", f"Room {room_name} is succesfuly reserved.")}'.encode()
+        # Reserve the room for every hour of the duration at once
+        try:
+            reserved = self.reserve_many(room_name, [(day, hour+d) for d in range(duration)])
+        except sqlite3.IntegrityError:
+            # The reservation was rolled back, find the first of the hours that is already reserved
+            cursor = self.local.cursor
+            cursor.execute(SELECT_RESERVED_HOUR, (room_name, day, hour, hour+duration-1))
+            reserved_hour = cursor.fetchone()
+            # Return a 403 Forbidden response
+            response = self.reserved_errors[reserved_hour[0]]
             return response
+        if not reserved:
+            # If the room does not exist, return a 400 Bad Request response
+            response = self.reserve_room_not_found_response
+            return response
+
+        # Mark the hours as reserved in memory, the cached availability of the room on that day is outdated
+        masks[day] |= requested_mask
+        self.invalidate_availability(room_name, (day,))
+
+        # Return a 200 OK response to confirm that the reservation was successful
+        response = self.build_response(self.ok_status, b"Reservation Successful", f"Room {html.escape(room_name)} is succesfuly reserved.".encode())
+        return response
+
+    def reserve_many(self, room_name, day_hours):
+        # Reserve the room at each of the (day, hour) pairs, the caller must hold self.lock.
+        # Returns False without reserving anything if the room does not exist.
+        # If any of the hours is already reserved, the unique index on the reservations raises sqlite3.IntegrityError and nothing is reserved.
+        cursor = self.local.cursor
+        # Check and reserve the room in a single transaction, so no other reservation can slip in between and there is a single commit.
+        # Leaving the with block commits the transaction, or rolls it back if an error is raised.
+        with self.local.db:
+            cursor.execute('BEGIN IMMEDIATE')
+            # Check if the specified room exists in the database
+            cursor.execute(SELECT_ROOM, (room_name,))
+            if cursor.fetchone() is None:
+                return False
+
+            # Insert all the hours with one batched insert
+            cursor.executemany(INSERT_RESERVATION, [(room_name, day, hour) for day, hour in day_hours])
+        return True
 
     def get_check_availability(self, query):
         # Check if all required parameters are present in the query dictionary
-        parameters_check = self.check_parameters(['name', 'day'], query)
+        parameters_check = self.check_parameters(self.availability_parameters, query)
         if parameters_check:
             return parameters_check
 
         room_name = query['name']
-        day = int(query['day'])
+        day = self.parse_number(query['day'])
+
+        # If the availability of the room on that day was already built, return it
+        response = self.availability_responses.get((room_name, day))
+        if response is not None:
+            return response
+        generation = self.availability_generation
 
-        # Get a cursor for the database
-        cursor = self.db.cursor()
-        # Check if the specified room exists in the database
-        cursor.execute("SELECT * FROM rooms WHERE name=?", (room_name,))
-        if cursor.fetchone() is None:
+        # Check if the specified room exists
+        masks = self.rooms.get(room_name)
+        if masks is None:
             # If the room does not exist, return a 400 Bad Request response
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Room Does not exist")}'.encode()
+            response = self.check_room_not_found_response
             return response
 
         # Check if the specified day is a valid day of the week
-        if not 1 <= day <= 7:
+        if day is None or not 1 <= day <= 7:
             # If the day is not a valid day of the week, return a 400 Bad Request response
-            response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", "Invalid day paramater")}'.encode()
+            response = self.check_invalid_day_response
             return response
 
-        # Get a list of all reservations for the specified room and day
-        cursor.execute("SELECT hour FROM reservations WHERE name=? AND day=?", (room_name, day))
-        reservations = cursor.fetchall()
-
-        # Create a list of all available hours (9-17)
-        availability = list(range(9, 18))
-        # Remove any reserved hours from the availability list
-        for reservation in reservations:
-            hour = reservation[0]
-            try:
-                availability.remove(hour)
-            except ValueError:
-                pass
-
-        # Create a string of available hours separated by commas
-        return_string = ',  '.join(map(str, availability))
-        # Create a 200 OK response with the availability information
-        response = f'HTTP/1.1 200 OK\n\n{self.base_html.format("Availability", f"The following hours are available: {return_string}")}'.encode()
+        # Create a 200 OK response with the availability information from the reserved hours of the day, and cache it
+        response = self.build_response(self.ok_status, b"Availability", self.format_availability(masks[day]))
+        self.cache_availability((room_name, day), generation, response)
         return response
 
+    def get_check_week_availability(self, query):
+        # Check if all required parameters are present in the query dictionary
+        parameters_check = self.check_parameters(self.name_parameters, query)
+        if parameters_check:
+            return parameters_check
+
+        room_name = query['name']
+
+        # If the availability of the room in the whole week was already built, return it
+        response = self.availability_responses.get(room_name)
+        if response is not None:
+            return response
+        generation = self.availability_generation
 
-    def create_tables(self):
-        cursor = self.db.cursor()
+        # Check if the specified room exists
+        masks = self.rooms.get(room_name)
+        if masks is None:
+            # If the room does not exist, return a 400 Bad Request response
+            response = self.check_room_not_found_response
+            return response
+
+        # Create a 200 OK response with the availability information of each day from Monday to Sunday, separated by line breaks
+        body = b'<br></br>'.join(self.format_availability(masks[day]) for day in range(1, 8))
+        response = self.build_response(self.ok_status, b"Week Availability", body)
+        self.cache_availability(room_name, generation, response)
+        return response
+
+    def load_rooms(self):
+        # Read all rooms and the masks of their reserved hours on each day from the database, the caller must hold self.lock
+        cursor = self.local.cursor
+        cursor.execute(SELECT_ROOMS)
+        rooms = {name: [0] * 8 for name, in cursor.fetchall()}
+        cursor.execute(SELECT_RESERVED_MASKS)
+        for name, day, mask in cursor.fetchall():
+            # Reservations left from removed rooms are skipped, they are loaded again if a room with the same name is added
+            if name in rooms:
+                rooms[name][day] = int(mask)
+        self.rooms = rooms
+
+    def cache_availability(self, key, generation, response):
+        # Store the availability response, unless the reservations changed since it was built
+        with self.availability_lock:
+            if generation == self.availability_generation:
+                self.availability_responses[key] = response
+
+    def invalidate_availability(self, room_name, days):
+        # Remove the cached availability of the room on the given days and in the whole week
+        with self.availability_lock:
+            self.availability_generation += 1
+            for day in days:
+                self.availability_responses.pop((room_name, day), None)
+            self.availability_responses.pop(room_name, None)
+
+    def format_availability(self, reserved_mask):
+        # Clear the reserved hours from the mask of all hours (9-17) and look up the text of the remaining available hours
+        return AVAILABILITY_STRINGS[FULL_DAY_MASK & ~reserved_mask]
+
+
+    def create_tables(self, db):
+        # Create the cursor once and return it, all the requests of the thread reuse it
+        cursor = db.cursor()
+        # Wait for a lock held by another connection to the same file instead of failing right away
+        cursor.execute('PRAGMA busy_timeout=5000')
+        # Use write-ahead logging so that readers do not block the writer and commits need fewer fsyncs
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-65536')
         # Create the rooms and reservations tables if they do not already exist
         cursor.execute(
             '''CREATE TABLE IF NOT EXISTS rooms (name text)'''
@@ -215,31 +398,54 @@ class RoomServer:
         cursor.execute(
             '''CREATE TABLE IF NOT EXISTS reservations (name text, day integer, hour integer)'''
         )
-        self.db.commit()
+        # Index the columns used to look up rooms and reservations so the queries do not scan the whole table.
+        # Databases written before the indexes existed may hold the same room or the same reserved hour more than once,
+        # in that case only the first of the duplicate rows is kept so the unique indexes can be created.
+        try:
+            cursor.execute(
+                '''CREATE UNIQUE INDEX IF NOT EXISTS idx_rooms_name ON rooms (name)'''
+            )
+        except sqlite3.IntegrityError:
+            cursor.execute(
+                '''DELETE FROM rooms WHERE rowid NOT IN (SELECT MIN(rowid) FROM rooms GROUP BY name)'''
+            )
+            cursor.execute(
+                '''CREATE UNIQUE INDEX IF NOT EXISTS idx_rooms_name ON rooms (name)'''
+            )
+        try:
+            cursor.execute(
+                '''CREATE UNIQUE INDEX IF NOT EXISTS idx_res_nameday ON reservations (name, day, hour)'''
+            )
+        except sqlite3.IntegrityError:
+            cursor.execute(
+                '''DELETE FROM reservations WHERE rowid NOT IN (SELECT MIN(rowid) FROM reservations GROUP BY name, day, hour)'''
+            )
+            cursor.execute(
+                '''CREATE UNIQUE INDEX IF NOT EXISTS idx_res_nameday ON reservations (name, day, hour)'''
+            )
+        return cursor
+
+    def build_response(self, status, title, body):
+        # Join the status line and the pre-encoded parts of the HTML template with the title and the body
+        return b''.join((status, self.html_head, title, self.html_middle, body, self.html_tail))
+
+    def parse_number(self, value):
+        # Convert a parameter to an integer, or return None if it is not a number
+        try:
+            return int(value)
+        except ValueError:
+            return None
 
     def check_parameters(self, parameters, query):
-        # Check that each required parameter is present in the query
-        for parameter in parameters:
-            if parameter not in query:
-                # If a required parameter is not present, return an error response
-                response = f'HTTP/1.1 400 Bad Request\n\n{self.base_html.format("Error", f"{parameter} parameter is mandatory")}'.encode()
-                return response
+        # Find the required parameters that are not present in the query with a single set difference
+        missing = parameters - query.keys()
+        if missing:
+            # If a required parameter is not present, return the error response of the first one in the order of required_parameters
+            return next(self.parameter_errors[parameter] for parameter in self.required_parameters if parameter in missing)
         # If all required parameters are present, return False
         return False
 
 
-def handle_request(server, connection):
-    try:
-        # Receive the request from the client
-        request = connection.recv(1024)
-        # Handle the request and get the response from the server
-        response = server.handle_request(request)
-        # Send the response to the client
-        connection.sendall(response)
-    finally:
-        # Close the connection
-        connection.close()
-
 if __name__ == '__main__':
     # Check that the server_port argument was passed to the script
     if len(sys.argv) < 2:
@@ -253,16 +459,5 @@ if __name__ == '__main__':
     # Create a RoomServer instance
     server = RoomServer()
 
-    # Create a TCP/IP socket and bind it to the host and server_port
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind((host, server_port))
-    # Start listening for incoming connections
-    sock.listen()
-
-    # Print a message indicating that the server is running on the specified port
-    print(f'{server.__class__.__name__} running on port {server_port}')
-
-    while True:
-        # Wait for a connection and pass it to the handle_request function
-        connection, _ = sock.accept()
-        handle_request(server, connection)
+    # Accept the connections and handle their requests
+    asyncio.run(serve(server, host, server_port))